@@ -13,20 +13,43 @@ error_exit () {
 # check aws cli program is available
 which aws >/dev/null 2>&1 || error_exit "Unable to find AWS CLI executable."
 
-aws s3 cp "${IMAGE_S3_URL}" "/data/${INPUT_TIFF}" || error_exit "Failed to download input ome-tiff file."
+cd /data
+
+# EXHIBIT_ONLY is set by the lambda when only story metadata (waypoints,
+# arrows, overlays) changed, in which case no pixels are rendered. The image
+# shape is then read from the previous exhibit.json, if there is one, so the
+# ome-tiff is not downloaded.
+PREVIEW_ARG="--preview"
+DOWNLOAD_TIFF="true"
+if [ -n "${EXHIBIT_ONLY}" ]; then
+  PREVIEW_ARG=""
+  if aws s3 cp "s3://${DIR_NAME}/${OUTPUT_DIR}/exhibit.json" "/data/${OUTPUT_DIR}/exhibit.json"; then
+    DOWNLOAD_TIFF=""
+  fi
+fi
+
+if [ -n "${DOWNLOAD_TIFF}" ]; then
+  aws s3 cp "${IMAGE_S3_URL}" "/data/${INPUT_TIFF}" || error_exit "Failed to download input ome-tiff file."
+fi
 aws s3 cp "${STORY_S3_URL}" "/data/${INPUT_JSON}" || error_exit "Failed to download author json file."
 
-cd /data
+echo "Writing exhibit file"
+python3 /usr/local/bin/save_exhibit_pyramid.py "${INPUT_TIFF}" "${INPUT_JSON}" "${OUTPUT_DIR}" --exhibit-only ${PREVIEW_ARG} || error_exit "Failed to write exhibit file."
+
+echo "Uploading exhibit file to S3"
+aws s3 cp "${OUTPUT_DIR}/" "s3://${DIR_NAME}/${OUTPUT_DIR}" --recursive --acl bucket-owner-full-control || error_exit "Failed to upload exhibit file to S3."
 
-echo "Running rendering script save_exhibit_pyramid.py"
-python3 /usr/local/bin/save_exhibit_pyramid.py "${INPUT_TIFF}" "${INPUT_JSON}" "${OUTPUT_DIR}" || error_exit "Failed to run save_exhibit_pyramid.py."
+if [ -z "${EXHIBIT_ONLY}" ]; then
+  echo "Running rendering script save_exhibit_pyramid.py"
+  python3 /usr/local/bin/save_exhibit_pyramid.py "${INPUT_TIFF}" "${INPUT_JSON}" "${OUTPUT_DIR}" --force ${MAX_MEMORY:+--max-memory "${MAX_MEMORY}"} || error_exit "Failed to run save_exhibit_pyramid.py."
 
-echo "Uploading jpeg pyramid and exhibit file to S3"
-aws s3 cp "${OUTPUT_DIR}/" "s3://${DIR_NAME}/${OUTPUT_DIR}" --recursive --acl bucket-owner-full-control || error_exit "Failed to upload output folder to S3."
+  echo "Uploading jpeg pyramid to S3"
+  aws s3 cp "${OUTPUT_DIR}/" "s3://${DIR_NAME}/${OUTPUT_DIR}" --recursive --acl bucket-owner-full-control || error_exit "Failed to upload output folder to S3."
+fi
 
 echo "Uploading index.html to S3"
 aws s3 cp /usr/local/bin/index.html "s3://${DIR_NAME}/${OUTPUT_DIR}/index.html" --acl bucket-owner-full-control || error_exit "Failed to upload index.html to S3."
 
 #clean up TIFF image and output directory
-rm "${INPUT_TIFF}"
+rm -f "${INPUT_TIFF}"
 rm -r "${OUTPUT_DIR}/"
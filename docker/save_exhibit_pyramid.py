@@ -4,12 +4,15 @@ import itertools
 import pathlib
 import json
 import os
+import gc
+import resource
 # Opener
 import zarr
 import numpy as np
 from PIL import Image
 from matplotlib import colors
 from tifffile import TiffFile
+import openslide
 from openslide import OpenSlide
 from openslide.deepzoom import DeepZoomGenerator
 # main
@@ -22,7 +25,19 @@ from json.decoder import JSONDecodeError
     # render_jpg.py
 '''
 
-def composite_channel(target, image, color, range_min, range_max):
+# Estimated bytes held per pixel while compositing one tile: float32 RGB
+# target, float32 scratch channel, uint16 source and uint8 RGB output
+TILE_BYTES_PER_PIXEL = 3 * 4 + 4 + 2 + 3
+# Share of the remaining memory budget given to the chunk cache
+CACHE_FRACTION = 0.5
+# Release caches once RSS reaches this share of the memory budget
+HIGH_WATER_FRACTION = 0.9
+# Longest side of group preview thumbnails in pixels
+PREVIEW_SIZE = 256
+# Skip previews when the coarsest level has more tiles than this
+PREVIEW_MAX_TILES = 16
+
+def composite_channel(target, image, color, range_min, range_max, scratch=None):
     ''' Render _image_ in pseudocolor and composite into _target_
     Args:
         target: Numpy float32 array containing composition target image
@@ -30,8 +45,13 @@ def composite_channel(target, image, color, range_min, range_max):
         color: Color as r, g, b float array, 0-1
         range_min: Threshhold range minimum, 0-65535
         range_max: Threshhold range maximum, 0-65535
+        scratch: Optional float32 array shaped like _image_ to reuse
     '''
-    f_image = (image.astype('float32') - range_min) / (range_max - range_min)
+    if scratch is None:
+        f_image = (image.astype('float32') - range_min) / (range_max - range_min)
+    else:
+        f_image = np.subtract(image, range_min, out=scratch, dtype=np.float32)
+        f_image = np.divide(f_image, range_max - range_min, out=f_image)
     f_image = f_image.clip(0,1, out=f_image)
     for i, component in enumerate(color):
         target[:, :, i] += f_image * component
@@ -45,7 +65,60 @@ def _calculate_total_tiles(opener, tile_size, num_levels):
 
     return tiles
 
-def render_color_tiles(opener, output_dir, tile_size, config_rows, logger, progress_callback=None):
+class MemoryBudget:
+    ''' Track resident memory of this process against a fixed budget
+    Args:
+        max_memory: Budget in megabytes, or None for no limit
+        logger: Logger for backpressure warnings
+    '''
+
+    def __init__(self, max_memory, logger):
+        self.max_bytes = None if max_memory is None else int(max_memory * 1024 ** 2)
+        self.logger = logger
+        self.peak = self.rss()
+
+    def rss(self):
+        try:
+            with open('/proc/self/statm') as statm:
+                pages = int(statm.read().split()[1])
+            return pages * resource.getpagesize()
+        except (OSError, IndexError, ValueError):
+            # Fall back to peak RSS, reported in kilobytes on Linux
+            return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+    def cache_size(self, tile_size):
+        ''' Bytes available to chunk caches after the per-tile working set
+        Args:
+            tile_size: Width and height of rendered tiles in pixels
+        '''
+        if self.max_bytes is None:
+            return 0
+        working_set = tile_size * tile_size * TILE_BYTES_PER_PIXEL
+        available = self.max_bytes - self.rss() - working_set
+        return max(0, int(available * CACHE_FRACTION))
+
+    def check(self, opener):
+        ''' Release cached data from _opener_ when RSS nears the budget
+        Args:
+            opener: Opener whose caches and buffers can be dropped
+        '''
+        rss = self.rss()
+        self.peak = max(self.peak, rss)
+        if self.max_bytes is None or rss < self.max_bytes * HIGH_WATER_FRACTION:
+            return
+
+        opener.release()
+        gc.collect()
+        rss = self.rss()
+        if rss >= self.max_bytes:
+            self.logger.warning(f'RSS {rss // 1024 ** 2} MB exceeds budget '
+                                f'{self.max_bytes // 1024 ** 2} MB after releasing caches')
+
+    def report(self):
+        print('Peak RSS {} MB'.format(self.peak // 1024 ** 2))
+
+def render_color_tiles(opener, output_dir, tile_size, config_rows, logger, progress_callback=None,
+                       memory_budget=None):
     EXT = 'jpg'
 
     for settings in config_rows:
@@ -91,6 +164,9 @@ def render_color_tiles(opener, output_dir, tile_size, config_rows, logger, progr
                 if progress_callback is not None:
                     progress_callback(progress, len(config_rows)*total_tiles)
 
+            if memory_budget is not None:
+                memory_budget.check(opener)
+
 '''
     # Opener
 '''
@@ -102,15 +178,25 @@ def check_ext(path):
 
 class Opener:
 
-    def __init__(self, path):
+    def __init__(self, path, cache_size=0):
         self.warning = ''
         self.path = path
         self.tilesize = 1024
+        self.cache = None
+        self.cache_size = cache_size
+        self.buffers = {}
         ext = check_ext(path)
 
         if ext == '.ome.tif' or ext == '.ome.tiff':
             self.io = TiffFile(self.path, is_ome=False)
-            self.group = zarr.open(self.io.series[0].aszarr())
+            store = self.io.series[0].aszarr()
+            # LRUStoreCache was removed in zarr 3
+            if cache_size and hasattr(zarr, 'LRUStoreCache'):
+                self.cache = zarr.LRUStoreCache(store, max_size=cache_size)
+                store = self.cache
+            elif cache_size:
+                print("zarr {} has no LRUStoreCache, reading without a chunk cache".format(zarr.__version__))
+            self.group = zarr.open(store)
             self.reader = 'tifffile'
             self.ome_version = self._get_ome_version()
             print("OME ", self.ome_version)
@@ -128,6 +214,10 @@ class Opener:
 
         else:
             self.io = OpenSlide(self.path)
+            # OpenSlideCache is only available with OpenSlide 4.0 and newer
+            if cache_size and hasattr(openslide, 'OpenSlideCache'):
+                self.cache = openslide.OpenSlideCache(cache_size)
+                self.io.set_cache(self.cache)
             self.dz = DeepZoomGenerator(self.io, tile_size=1024, overlap=0, limit_bounds=True)
             self.reader = 'openslide'
             self.rgba = True
@@ -154,6 +244,31 @@ class Opener:
     def close(self):
         self.io.close()
 
+    def release(self):
+        ''' Drop cached chunks and pooled buffers to reduce memory '''
+        self.buffers.clear()
+        if self.reader == 'tifffile' and self.cache is not None:
+            self.cache.invalidate()
+        elif self.reader == 'openslide' and self.cache is not None:
+            self.cache = openslide.OpenSlideCache(self.cache_size)
+            self.io.set_cache(self.cache)
+
+    def get_buffer(self, name, shape, dtype, zero=True):
+        ''' Return an array from the buffer pool, reused across tiles
+        Args:
+            name: Pool key for the buffer
+            shape: Required array shape
+            dtype: Required numpy dtype
+            zero: Set false when the caller overwrites the whole buffer
+        '''
+        buffer = self.buffers.get(name)
+        if buffer is None or buffer.shape != shape or buffer.dtype != dtype:
+            buffer = np.zeros(shape, dtype)
+            self.buffers[name] = buffer
+        elif zero:
+            buffer.fill(0)
+        return buffer
+
     def is_rgba(self, rgba_type=None):
         if rgba_type is None:
             return self.rgba
@@ -271,6 +386,10 @@ class Opener:
             return img
 
     def save_tile(self, output_file, settings, tile_size, level, tx, ty, is_mask=False):
+        img = self.render_tile(settings, tile_size, level, tx, ty, is_mask)
+        img.save(output_file, quality=85)
+
+    def render_tile(self, settings, tile_size, level, tx, ty, is_mask=False):
         if self.reader == 'tifffile' and self.is_rgba('3 channel'):
 
             num_channels = self.get_shape()[0]
@@ -283,7 +402,6 @@ class Opener:
             tile[:,:,2] = tile_2
 
             img = Image.fromarray(tile, 'RGB')
-            img.save(output_file, quality=85)
 
         elif self.reader == 'tifffile' and self.is_rgba('1 channel'):
 
@@ -291,7 +409,6 @@ class Opener:
             tile = self.get_tifffile_tile(num_channels, level, tx, ty, 0, tile_size)
 
             img = Image.fromarray(tile, 'RGB')
-            img.save(output_file, quality=85)
 
         elif self.reader == 'tifffile' and is_mask:
             color = settings['Color'][0]
@@ -302,7 +419,6 @@ class Opener:
                 target, tile, colors.to_rgb(color)
             )
             img = Image.frombytes('RGBA', target.T.shape[1:], target.tobytes())
-            img.save(output_file, quality=85)
 
         elif self.reader == 'tifffile' and not is_mask:
             for i, (marker, color, start, end) in enumerate(zip(
@@ -319,21 +435,24 @@ class Opener:
                         tile = tile.astype(np.uint16)
 
                 if i == 0:
-                    target = np.zeros(tile.shape + (3,), np.float32)
+                    target = self.get_buffer('target', tile.shape + (3,), np.float32)
+                    scratch = self.get_buffer('scratch', tile.shape, np.float32)
 
                 composite_channel(
-                    target, tile, colors.to_rgb(color), float(start), float(end)
+                    target, tile, colors.to_rgb(color), float(start), float(end), scratch
                 )
 
             np.clip(target, 0, 1, out=target)
-            target_u8 = (target * 255).astype(np.uint8)
+            np.multiply(target, 255, out=target)
+            target_u8 = self.get_buffer('target_u8', target.shape, np.uint8, zero=False)
+            np.copyto(target_u8, target, casting='unsafe')
             img = Image.frombytes('RGB', target.T.shape[1:], target_u8.tobytes())
-            img.save(output_file, quality=85)
 
         elif self.reader == 'openslide':
             l = self.dz.level_count - 1 - level
             img = self.dz.get_tile(l, (tx, ty))
-            img.save(output_file, quality=85)
+
+        return img
 
 '''
     # main
@@ -406,9 +525,66 @@ def make_rows(d):
             'Color': ['#' + c['color'] for c in channels]
         }
 
-def render(opener, saved, output_dir, logger):
+def render_previews(opener, output_dir, tile_size, config_rows, logger, memory_budget=None):
+    ''' Render one small thumbnail per group from the coarsest level only
+    Args:
+        opener: Opener for the input image
+        output_dir: Output directory, thumbnails are written to its preview folder
+        tile_size: Width and height of rendered tiles in pixels
+        config_rows: Group rendering settings from make_rows
+        logger: Logger for tile errors
+        memory_budget: Optional MemoryBudget checked after each tile
+    '''
+    level = opener.get_shape()[1] - 1
+    (nx, ny) = opener.get_level_tiles(level, tile_size)
+
+    # Images with few levels have a large coarsest level, which would not be
+    # a quick preview and would hold a full resolution level in memory
+    if nx * ny > PREVIEW_MAX_TILES:
+        logger.warning(f'Skipping previews, level {level} has {nx * ny} tiles')
+        return
+
+    preview_path = pathlib.Path(output_dir) / 'preview'
+    if not preview_path.exists():
+        preview_path.mkdir(parents=True)
+
+    # Tiles are shrunk before pasting so the canvas never exceeds PREVIEW_SIZE
+    scale = PREVIEW_SIZE / (max(nx, ny) * tile_size)
+
+    for settings in config_rows:
+        canvas = Image.new('RGB', (PREVIEW_SIZE, PREVIEW_SIZE))
+        (width, height) = (0, 0)
+
+        for ty, tx in itertools.product(range(0, ny), range(0, nx)):
+            try:
+                img = opener.render_tile(settings, tile_size, level, tx, ty)
+            except AttributeError as e:
+                logger.error(f'{level} ty {ty} tx {tx}: {e}')
+                continue
+            size = (max(1, round(img.width * scale)), max(1, round(img.height * scale)))
+            (x, y) = (round(tx * tile_size * scale), round(ty * tile_size * scale))
+            canvas.paste(img.convert('RGB').resize(size), (x, y))
+            width = min(PREVIEW_SIZE, max(width, x + size[0]))
+            height = min(PREVIEW_SIZE, max(height, y + size[1]))
+
+            if memory_budget is not None:
+                memory_budget.check(opener)
+
+        if width == 0 or height == 0:
+            logger.warning(f'No preview rendered for {settings["Group Path"]}')
+            continue
+
+        thumbnail = canvas.crop((0, 0, width, height))
+        thumbnail.save(str(preview_path / (settings['Group Path'] + '.jpg')), quality=85)
+
+def preview(opener, saved, output_dir, logger, memory_budget=None):
+    config_rows = list(make_rows(saved['groups']))
+    render_previews(opener, output_dir, 1024, config_rows, logger, memory_budget)
+
+def render(opener, saved, output_dir, logger, memory_budget=None):
     config_rows = list(make_rows(saved['groups']))
-    render_color_tiles(opener, output_dir, 1024, config_rows, logger)
+    render_color_tiles(opener, output_dir, 1024, config_rows, logger,
+                       memory_budget=memory_budget)
 
 def format_arrow(a):
     return {
@@ -459,9 +635,18 @@ def make_groups(d):
             'Channels': [c['label'] for c in group['channels']]
         }
 
-def make_exhibit_config(opener, root_url, saved):
+def shape_from_exhibit(exhibit_json):
+    ''' Read the image shape from a previously written exhibit file
+    Args:
+        exhibit_json: Path to exhibit.json written by an earlier run
+    '''
+    with open(exhibit_json) as json_file:
+        image = json.load(json_file)['Images'][0]
+    return (None, image['MaxLevel'] + 1, image['Width'], image['Height'])
+
+def make_exhibit_config(opener, root_url, saved, shape=None):
 
-    (num_channels, num_levels, width, height) = opener.get_shape()
+    (num_channels, num_levels, width, height) = shape if shape else opener.get_shape()
 
     return {
         'Images': [{
@@ -480,7 +665,8 @@ def make_exhibit_config(opener, root_url, saved):
         'Masks': []
     }
 
-def main(ome_tiff, author_json, output_dir, root_url, force=False):
+def main(ome_tiff, author_json, output_dir, root_url, force=False, max_memory=None,
+         exhibit_only=False, preview_groups=False):
    FORMATTER = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
    logger = logging.getLogger('app')
    ch = logging.StreamHandler()
@@ -490,13 +676,27 @@ def main(ome_tiff, author_json, output_dir, root_url, force=False):
 
    opener = None
    saved = None
-
-   try:
-      opener = Opener(ome_tiff)
-   except (FileNotFoundError, TiffFileError) as e:
-       logger.error(e)
-       logger.error(f'Invalid ome-tiff file: cannot parse {ome_tiff}')
-       return
+   shape = None
+   memory_budget = MemoryBudget(max_memory, logger)
+   previous_exhibit = pathlib.Path(output_dir) / 'exhibit.json'
+
+   # An exhibit-only rebuild can take the image shape from the previous
+   # exhibit file, so the OME-TIFF need not be downloaded
+   if exhibit_only and not os.path.exists(ome_tiff) and previous_exhibit.exists():
+      try:
+          shape = shape_from_exhibit(previous_exhibit)
+          print(f'Image shape from {previous_exhibit}')
+      except (JSONDecodeError, KeyError, IndexError) as e:
+          logger.error(e)
+          logger.error(f'Invalid exhibit file: cannot parse {previous_exhibit}')
+          return
+   else:
+      try:
+         opener = Opener(ome_tiff, memory_budget.cache_size(1024))
+      except (FileNotFoundError, TiffFileError) as e:
+          logger.error(e)
+          logger.error(f'Invalid ome-tiff file: cannot parse {ome_tiff}')
+          return
 
    try:
        with open(author_json) as json_file:
@@ -507,23 +707,30 @@ def main(ome_tiff, author_json, output_dir, root_url, force=False):
        logger.error(f'Invalid save file: cannot parse {json_file}')
        return
 
-   if not force and os.path.exists(output_dir):
+   if not force and not exhibit_only and os.path.exists(output_dir):
       logger.error(f'Refusing to overwrite output directory {output_dir}')
       return
-   elif force and os.path.exists(output_dir):
+   elif os.path.exists(output_dir):
       logger.warning(f'Writing to existing output directory {output_dir}')
 
    output_path = pathlib.Path(output_dir)
    if not output_path.exists():
         output_path.mkdir(parents=True)
 
-   exhibit_config = make_exhibit_config(opener, root_url, saved)
+   exhibit_config = make_exhibit_config(opener, root_url, saved, shape)
 
    with open(output_dir / 'exhibit.json', 'w') as wf:
        json_text = json.dumps(exhibit_config, ensure_ascii=False)
        wf.write(json_text)
 
-   render(opener, saved, output_dir, logger)
+   if preview_groups and opener is not None:
+       preview(opener, saved, output_dir, logger, memory_budget)
+
+   if exhibit_only:
+       return
+
+   render(opener, saved, output_dir, logger, memory_budget)
+   memory_budget.report()
 
 if __name__ == '__main__':
 
@@ -545,6 +752,18 @@ if __name__ == '__main__':
         help="URL to planned hosting location of rendered JPEG pyramid",
     )
     parser.add_argument('--force', help='Overwrite output', action='store_true')
+    parser.add_argument(
+        "--max-memory", metavar="MB", type=int, default=None,
+        help="Memory budget in megabytes used to size caches and release them under pressure",
+    )
+    parser.add_argument(
+        '--exhibit-only', action='store_true',
+        help='Only write exhibit.json, without rendering the JPEG pyramid',
+    )
+    parser.add_argument(
+        '--preview', action='store_true',
+        help='Write a thumbnail per group from the coarsest level before rendering',
+    )
     args = parser.parse_args()
 
     ome_tiff = args.ome_tiff
@@ -552,5 +771,9 @@ if __name__ == '__main__':
     output_dir = args.output_dir
     root_url = args.url
     force = args.force
+    max_memory = args.max_memory
+    exhibit_only = args.exhibit_only
+    preview_groups = args.preview
 
-    main(ome_tiff, author_json, output_dir, root_url, force)
+    main(ome_tiff, author_json, output_dir, root_url, force, max_memory,
+         exhibit_only, preview_groups)
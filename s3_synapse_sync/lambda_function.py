@@ -13,62 +13,225 @@ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 See the License for the specific language governing permissions and
 limitations under the License.
 """
+import time
+_IMPORT_START = time.perf_counter()
+
 import json
 import os
 import sys
 
+from contextlib import contextmanager
 from urllib.parse import unquote_plus
-from botocore.errorfactory import ClientError
 import base64
-import boto3
 import hashlib
+import importlib
 import mimetypes
 import re
-import synapseclient
 import tempfile
+import threading
 import uuid
 
-s3 = boto3.client('s3')
-ssm = boto3.client('ssm')
-s3_resource = boto3.resource('s3')
-batch = boto3.client('batch')
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
 MD5_BLOCK_SIZE = 50 * 1024 ** 2
+# Concurrent Synapse calls per invocation, also the HTTP connection pool size
+SYNAPSE_WORKERS = 4
+# synapseclient retries these itself, they are only observed to adapt the rate
+THROTTLE_STATUS_CODES = (429, 503)
+# Recently deleted Synapse paths, used to skip folder walks for the rest of
+# a bulk cleanup. Entries expire a fixed time after the delete.
+DELETED_PATHS_SIZE = 10000
+DELETED_PATH_TTL = 60
+
+# boto3, botocore and synapseclient are imported, and AWS clients created,
+# on first use so that cold starts only pay for what an event needs
+_modules = {}
+_clients = {}
+_cold_start = True
+_executor = None
+_deleted_paths = OrderedDict()
+_storage_locations = {}
+_pat = None
+
+class Metrics:
+    """
+    Per-invocation stage timings and counters, emitted as a CloudWatch
+    Embedded Metric Format log line.
+    """
+    NAMESPACE = 'S3SynapseSync'
+
+    def __init__(self):
+        self.timings = {}
+        self.counts = {}
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def timer(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = (time.perf_counter() - start) * 1000
+            with self.lock:
+                self.timings[stage] = self.timings.get(stage, 0) + elapsed
+
+    def count(self, name, value=1):
+        with self.lock:
+            self.counts[name] = self.counts.get(name, 0) + value
+
+    def emit(self, event_type):
+        metrics = [{'Name': stage + 'Time', 'Unit': 'Milliseconds'} for stage in self.timings]
+        metrics += [{'Name': name, 'Unit': 'Bytes' if name.startswith('Bytes') else 'Count'}
+                    for name in self.counts]
+        record = {
+            '_aws': {
+                'Timestamp': int(time.time() * 1000),
+                'CloudWatchMetrics': [{
+                    'Namespace': self.NAMESPACE,
+                    'Dimensions': [['EventType']],
+                    'Metrics': metrics
+                }]
+            },
+            'EventType': event_type
+        }
+        record.update({stage + 'Time': round(ms, 3) for stage, ms in self.timings.items()})
+        record.update(self.counts)
+        print(json.dumps(record))
+
+_metrics = Metrics()
+
+class TokenBucket:
+    """
+    Thread-safe token bucket limiting Synapse calls per second. The rate is
+    halved when Synapse throttles a call and recovers gradually on success.
+    """
+
+    def __init__(self, rate, min_rate, max_rate, increase):
+        self.rate = rate
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.increase = increase
+        self.tokens = rate
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def throttled(self):
+        with self.lock:
+            self.rate = max(self.min_rate, self.rate / 2)
+            self.tokens = min(self.tokens, self.rate)
+
+    def succeeded(self):
+        with self.lock:
+            self.rate = min(self.max_rate, self.rate + self.increase)
+
+# Shared across warm invocations so a throttled rate carries over
+_rate_limiter = TokenBucket(rate=10, min_rate=1, max_rate=20, increase=0.1)
 
 def lambda_handler(event, context):
+    global _cold_start, _metrics, _pat
+    _metrics = Metrics()
+    _pat = None
+    if _cold_start:
+        _cold_start = False
+        _metrics.count('ColdStart')
+        print("Cold start: module import took {:.1f} ms.".format(
+            (_IMPORT_DONE - _IMPORT_START) * 1000))
     print(event)
-    eventname = event['Records'][0]['eventName']
-    bucket = event['Records'][0]['s3']['bucket']['name']
-    key = unquote_plus(event['Records'][0]['s3']['object']['key'])
-
-    filename = os.path.basename(key)
-    dirname = os.path.dirname(key)
-    filepath = bucket+'/'+dirname
-    prefix='minerva'
+    records = unwrap_records(event)
+    event_types = {record['eventName'].split(':')[0] for record in records}
+    event_type = event_types.pop() if len(event_types) == 1 else 'Mixed'
+    _metrics.count('Records', len(records))
+    try:
+        with _metrics.timer('Total'):
+            handle_records(records)
+    finally:
+        _metrics.emit(event_type)
+
+def unwrap_records(event):
+    """
+    Return the S3 event records of a direct S3 notification, or of a batch of
+    SQS messages each carrying an S3 notification. s3:TestEvent messages,
+    which have no records, are dropped.
+    """
+    records = []
+    for record in event.get('Records', []):
+        if record.get('eventSource') == 'aws:sqs':
+            records.extend(json.loads(record['body']).get('Records', []))
+        else:
+            records.append(record)
+    return latest_records(records)
 
-    if dirname == prefix and key.endswith('story.json'):
-        try:
-            input_tiff = tiff_in_file(bucket,key)
-            s3.head_object(Bucket=bucket, Key=dirname+'/'+input_tiff)
-        except ClientError as e:
-            if e.response['Error']['Code'] == "404":
-                print("{} image not found.".format(input_tiff))
+def latest_records(records):
+    """
+    Keep only the last event for each object, so a removal and a re-upload of
+    the same key in one batch are not applied out of order. S3 sequencers of
+    one key compare as hex strings once padded to the same length.
+    """
+    latest = OrderedDict()
+    for index, record in enumerate(records):
+        obj = (record['s3']['bucket']['name'], record['s3']['object']['key'])
+        order = (record['s3']['object'].get('sequencer', '').rjust(32, '0'), index)
+        if obj not in latest or order > latest[obj][0]:
+            latest[obj] = (order, record)
+    return [record for (order, record) in latest.values()]
+
+def handle_records(records):
+    removed = {}
+    for record in records:
+        eventname = record['eventName']
+        bucket = record['s3']['bucket']['name']
+        key = unquote_plus(record['s3']['object']['key'])
+
+        filename = os.path.basename(key)
+        dirname = os.path.dirname(key)
+        filepath = bucket+'/'+dirname
+        prefix='minerva'
+
+        if dirname == prefix and key.endswith('story.json'):
+            try:
+                input_tiff = tiff_in_file(bucket,key)
+                _get_client('s3').head_object(Bucket=bucket, Key=dirname+'/'+input_tiff)
+            except _import('botocore.exceptions').ClientError as e:
+                if e.response['Error']['Code'] == "404":
+                    print("{} image not found.".format(input_tiff))
+                else:
+                    raise
             else:
-                raise
+                exhibit_only = is_exhibit_only(bucket,key)
+                submit_batch_job(input_tiff,filename,filepath,exhibit_only)
+        elif dirname == prefix and (key.endswith('ome.tif') or key.endswith('ome.tiff')):
+            story_json_files = get_story_json(bucket,filename,prefix)
+            for file in story_json_files:
+                input_json = os.path.basename(file)
+                submit_batch_job(filename,input_json,filepath)
+
+        if 'ObjectRemoved' in eventname:
+            # Collected so removals under a deleted folder are collapsed
+            removed.setdefault(bucket, []).append(key)
         else:
-            submit_batch_job(input_tiff,filename,filepath)
-    elif dirname == prefix and (key.endswith('ome.tif') or key.endswith('ome.tiff')):
-        story_json_files = get_story_json(bucket,filename,prefix)
-        for file in story_json_files:
-            input_json = os.path.basename(file)
-            submit_batch_job(filename,input_json,filepath)
+            sync_to_synapse(bucket,{'Records': [record]},eventname,filename,key)
 
-    sync_to_synapse(bucket,event,eventname,filename,key)
+    for bucket, keys in removed.items():
+        delete_from_synapse(bucket, keys)
 
 def tiff_in_file(bucket,key):
     """
     Read story.json file to get name of corresponding ome-tiff image
     """
-    content_object = s3_resource.Object(bucket, key)
+    content_object = _get_resource('s3').Object(bucket, key)
     file_content = content_object.get()['Body'].read().decode('utf-8')
     json_content = json.loads(file_content)
     in_file = os.path.basename(json_content['in_file'].replace('\\',os.sep))
@@ -78,7 +241,7 @@ def tiff_in_file(bucket,key):
 def get_story_json(bucket,filename,prefix):
     story_json = []
 
-    file_list = s3.list_objects_v2(Bucket=bucket,Prefix=prefix)
+    file_list = _get_client('s3').list_objects_v2(Bucket=bucket,Prefix=prefix)
     for obj in file_list.get('Contents', []):
         file = obj['Key']
         if file.endswith('story.json'):
@@ -88,54 +251,104 @@ def get_story_json(bucket,filename,prefix):
 
     return story_json
 
-def submit_batch_job(input_tiff,input_json,filepath):
-    response = batch.submit_job(jobName=re.sub('[^0-9a-zA-Z]+', '-', input_json)+'-batch-minerva-processor',
+def is_exhibit_only(bucket,key):
+    """
+    Check whether the story.json was uploaded with exhibit-only metadata,
+    marking a metadata-only change that needs no pixel rendering
+    """
+    header = _get_client('s3').head_object(Bucket=bucket, Key=key)
+    return header['Metadata'].get('exhibit-only', '').lower() == 'true'
+
+def submit_batch_job(input_tiff,input_json,filepath,exhibit_only=False):
+    environment = [
+        {"name": "INPUT_TIFF", "value": input_tiff},
+        {"name": "INPUT_JSON", "value": input_json},
+        {"name": "DIR_NAME", "value": filepath}
+    ]
+    if exhibit_only:
+        environment.append({"name": "EXHIBIT_ONLY", "value": "1"})
+
+    response = _get_client('batch').submit_job(jobName=re.sub('[^0-9a-zA-Z]+', '-', input_json)+'-batch-minerva-processor',
                                 jobQueue=_get_env_var('JOB_QUEUE'),
                                 jobDefinition=_get_env_var('JOB_DEFINITION'),
-                                containerOverrides={
-                                    "environment": [
-                                        {"name": "INPUT_TIFF", "value": input_tiff},
-                                        {"name": "INPUT_JSON", "value": input_json},
-                                        {"name": "DIR_NAME", "value": filepath}
-                                    ]
-                                })
+                                containerOverrides={"environment": environment})
 
     print("Job ID is {}.".format(response['jobId']))
 
 def sync_to_synapse(bucket,event,eventname,filename,key):
+    if key[0].isdigit() or 'ObjectCreated' not in eventname:
+        return
+
+    syn, project_id = login_synapse(bucket)
+    _forget_deleted(project_id, key)
+    create_filehandle(syn, event, filename, bucket, key, project_id)
+
+def delete_from_synapse(bucket, keys):
+    """
+    Delete removed S3 keys from Synapse. Keys under a folder marker removed in
+    the same batch are dropped, the top-most folders left empty in S3 are
+    deleted with one call each, and the remaining keys share folder lookups.
+    """
+    collapsed = collapse_prefixes(keys)
+    _metrics.count('DeletesCollapsed', len(keys) - len(collapsed))
+    collapsed = [key for key in collapsed if not key[0].isdigit()]
+    if not collapsed:
+        return
+
+    empty = []
+    for prefix in common_prefixes(collapsed):
+        if not any(prefix.startswith(e) for e in empty) and _prefix_is_empty(bucket, prefix):
+            empty.append(prefix)
+    remaining = [key for key in collapsed if not any(key.startswith(e) for e in empty)]
+    _metrics.count('DeletesCollapsed', len(collapsed) - len(empty) - len(remaining))
+
+    syn, project_id = login_synapse(bucket)
+    folder_cache = {}
+    for key in empty + remaining:
+        if _was_deleted(syn, project_id, key):
+            _metrics.count('DeletesSkipped')
+            continue
+        delete_object(syn, os.path.basename(key), project_id, key, folder_cache)
+
+def login_synapse(bucket):
     envvars = _get_env_var('BUCKET_VARIABLES')
     env_dict = json.loads(envvars)
     project_id = env_dict[bucket]['SynapseProjectId']
 
-    ssm_pat = '/HTAN/SynapseSync/PAT'
-    pat = ssm.get_parameter(Name=ssm_pat, WithDecryption=True)['Parameter']['Value']
+    global _pat
+    if _pat is None:   # Looked up once per invocation, not per record
+        ssm_pat = '/HTAN/SynapseSync/PAT'
+        with _metrics.timer('SSMLookup'):
+            _pat = _get_client('ssm').get_parameter(Name=ssm_pat, WithDecryption=True)['Parameter']['Value']
 
-    synapseclient.core.cache.CACHE_ROOT_DIR = '/tmp/.synapseCache'
-    syn = synapseclient.Synapse()
-    syn.login(authToken=pat)
+    with _metrics.timer('Login'):
+        syn = _get_synapse(_pat)
 
-    if key[0].isdigit() == False:
-        if 'ObjectCreated' in eventname:
-            create_filehandle(syn, event, filename, bucket, key, project_id)
-        elif 'ObjectRemoved' in eventname:
-            delete_object(syn, filename, project_id, key)
+    return syn, project_id
 
 def create_filehandle(syn, event, filename, bucket, key, project_id):
-    parent_id = get_parent_folder(syn, project_id, key)
+    with _metrics.timer('ParentFolder'):
+        parent_id = get_parent_folder(syn, project_id, key)
     if parent_id == project_id:
         return   # Do not sync files at the root level
 
-    header = s3.head_object(Bucket=bucket, Key=key)
-    md5 = get_md5(event, header, bucket, key)
-    file_id = syn.findEntityId(filename, parent_id)
+    # The existence check runs on the pool while the MD5 is resolved
+    file_id_future = _submit('FindEntity', syn.findEntityId, filename, parent_id)
+
+    with _metrics.timer('HeadObject'):
+        header = _get_client('s3').head_object(Bucket=bucket, Key=key)
+    with _metrics.timer('MD5'):
+        md5 = get_md5(event, header, bucket, key)
+    file_id = file_id_future.result()
 
     if file_id != None:
-        targetMD5 = syn.get(file_id, downloadFile=False)['md5'];
+        with _metrics.timer('GetEntity'):
+            targetMD5 = _synapse_call(syn.get, file_id, downloadFile=False)['md5'];
 
     if file_id == None or md5 != targetMD5:
         size = event['Records'][0]['s3']['object']['size']
         contentType = mimetypes.guess_type(filename, strict=False)[0]
-        storage_id = syn.restGET("/projectSettings/"+project_id+"/type/upload")['locations'][0]
+        storage_id = get_storage_location(syn, project_id)
 
         fileHandle = {'concreteType': 'org.sagebionetworks.repo.model.file.S3FileHandle',
                             'fileName'    : filename,
@@ -145,37 +358,101 @@ def create_filehandle(syn, event, filename, bucket, key, project_id):
                             'bucketName'  : bucket,
                             'key'         : key,
                             'storageLocationId': storage_id}
-        fileHandle = syn.restPOST('/externalFileHandle/s3', json.dumps(fileHandle), endpoint=syn.fileHandleEndpoint)
-        f = synapseclient.File(parentId=parent_id, dataFileHandleId=fileHandle['id'], name=filename, synapseStore=False)
-        f = syn.store(f)
+        with _metrics.timer('CreateFileHandle'):
+            fileHandle = _synapse_call(syn.restPOST, '/externalFileHandle/s3', json.dumps(fileHandle), endpoint=syn.fileHandleEndpoint)
+        f = _import('synapseclient').File(parentId=parent_id, dataFileHandleId=fileHandle['id'], name=filename, synapseStore=False)
+        with _metrics.timer('StoreEntity'):
+            f = _synapse_call(syn.store, f)
+
+def get_storage_location(syn, project_id):
+    """
+    Look up the project's upload storage location once per container.
+    """
+    if project_id not in _storage_locations:
+        with _metrics.timer('StorageLocation'):
+            settings = _synapse_call(syn.restGET, "/projectSettings/"+project_id+"/type/upload")
+        _storage_locations[project_id] = settings['locations'][0]
+    return _storage_locations[project_id]
 
 def get_parent_folder(syn, project_id, key, create_folders=True):
-    parent_id = project_id
+    folder_ids = get_folder_ids(syn, project_id, key, create_folders)
+    return None if folder_ids is None else folder_ids[-1]
+
+def get_folder_ids(syn, project_id, key, create_folders=True, folder_cache=None):
+    """
+    Return the Synapse IDs of the project and of each folder on the path to
+    key, or None if a folder is missing and create_folders is False. Folder
+    IDs found are kept in folder_cache, keyed by path, when one is given.
+    """
+    folder_ids = [project_id]
     folders = key.split('/')
     folders.pop(-1)
-
-    if folders:
-        for f in folders:
-            folder_id = syn.findEntityId(f, parent_id)
-            if folder_id == None:
-                if not create_folders:
-                    return None
-
-                folder_id = syn.store(synapseclient.Folder(name=f, parent=parent_id), forceVersion=False)['id']
-            parent_id = folder_id
-
-    return parent_id
-
-def delete_object(syn, filename, project_id, key):
-    parent_id = get_parent_folder(syn, project_id, key, False)
-    if parent_id == None:  # Parent folder does not exist on Synapse
+    folder_cache = {} if folder_cache is None else folder_cache
+
+    for i, f in enumerate(folders):
+        path = '/'.join(folders[:i + 1])
+        folder_id = folder_cache.get(path)
+        if folder_id == None:
+            folder_id = _synapse_call(syn.findEntityId, f, folder_ids[-1])
+        if folder_id == None:
+            if not create_folders:
+                return None
+
+            folder_id = _synapse_call(syn.store, _import('synapseclient').Folder(name=f, parent=folder_ids[-1]), forceVersion=False)['id']
+        folder_cache[path] = folder_id
+        folder_ids.append(folder_id)
+
+    return folder_ids
+
+def delete_object(syn, filename, project_id, key, folder_cache=None):
+    with _metrics.timer('ParentFolder'):
+        folder_ids = get_folder_ids(syn, project_id, key, False, folder_cache)
+    if folder_ids == None:  # Parent folder does not exist on Synapse
         return
+    parent_id = folder_ids[-1]
+
+    with _metrics.timer('Delete'):
+        if not filename:   # Object is a folder, deleted with its children
+            _synapse_call(syn.delete, parent_id)
+            container_id = folder_ids[-2]
+            name = key.rstrip('/').split('/')[-1]
+            if folder_cache:
+                for path in [path for path in folder_cache if (path + '/').startswith(key)]:
+                    folder_cache.pop(path)
+        else:              # Delete file
+            file_id = _synapse_call(syn.findEntityId, filename, parent_id)
+            if file_id == None:   # Already removed from Synapse
+                return
+            _synapse_call(syn.delete, file_id)
+            container_id = parent_id
+            name = filename
+    _mark_deleted(project_id, key.rstrip('/'), container_id, name)
+
+def collapse_prefixes(keys):
+    """
+    Reduce removed keys to the top-most ones, dropping keys that sit under a
+    removed folder since deleting the folder on Synapse removes its children.
+    """
+    folders = [key for key in keys if key.endswith('/')]
+    return [key for key in sorted(set(keys))
+            if not any(key != folder and key.startswith(folder) for folder in folders)]
 
-    if not filename:   # Object is a folder
-        syn.delete(parent_id)
-    else:              # Delete file
-        file_id = syn.findEntityId(filename, parent_id)
-        syn.delete(file_id)
+def common_prefixes(keys):
+    """
+    Return the folder prefixes above removed keys, shallowest first, e.g.
+    'a/' and 'a/b/' for 'a/b/c.txt' or for the folder marker 'a/b/c/'.
+    """
+    prefixes = set()
+    for key in keys:
+        folders = key.rstrip('/').split('/')[:-1]
+        for i in range(1, len(folders) + 1):
+            prefixes.add('/'.join(folders[:i]) + '/')
+    return sorted(prefixes, key=lambda prefix: (prefix.count('/'), prefix))
+
+def _prefix_is_empty(bucket, prefix):
+    with _metrics.timer('ListPrefix'):
+        response = _get_client('s3').list_objects_v2(Bucket=bucket, Prefix=prefix, MaxKeys=1)
+    return response['KeyCount'] == 0
 
 def get_md5(event, header, bucket, key):
     """
@@ -187,7 +464,7 @@ def get_md5(event, header, bucket, key):
     elif "content-md5" in header['Metadata']:
         md5 = base64.b64decode(header['Metadata']['content-md5']).hex()
     else:
-        s3_object = s3.get_object(Bucket=bucket, Key=key)
+        s3_object = _get_client('s3').get_object(Bucket=bucket, Key=key)
         md5 = md5sum(s3_object["Body"])
     return md5
 
@@ -214,11 +491,131 @@ def _block_hash(file_obj, blocksize, hash=None):
         hash = hashlib.md5()
     for block in iter(lambda: file_obj.read(blocksize), b""):
         hash.update(block)
+        _metrics.count('BytesHashed', len(block))
     return hash
 
+def _ancestor_paths(project_id, key):
+    parts = key.rstrip('/').split('/')
+    return [(project_id, '/'.join(parts[:i])) for i in range(1, len(parts) + 1)]
+
+def _was_deleted(syn, project_id, key):
+    """
+    Check whether key or one of its folders was deleted within the TTL and is
+    still absent. Another container may have re-created it since, so a hit is
+    confirmed with one lookup in the cached parent instead of a folder walk.
+    """
+    now = time.monotonic()
+    for path in _ancestor_paths(project_id, key):
+        entry = _deleted_paths.get(path)
+        if entry is None:
+            continue
+        (deleted_at, container_id, name) = entry
+        if now - deleted_at >= DELETED_PATH_TTL:
+            _deleted_paths.pop(path)
+            continue
+        if _synapse_call(syn.findEntityId, name, container_id) == None:
+            return True
+        _deleted_paths.pop(path)
+        return False
+    return False
+
+def _mark_deleted(project_id, path, container_id, name):
+    _deleted_paths[(project_id, path)] = (time.monotonic(), container_id, name)
+    _deleted_paths.move_to_end((project_id, path))
+    while len(_deleted_paths) > DELETED_PATHS_SIZE:
+        _deleted_paths.popitem(last=False)
+
+def _forget_deleted(project_id, key):
+    for path in _ancestor_paths(project_id, key):
+        _deleted_paths.pop(path, None)
+
+def _get_synapse(pat):
+    """
+    Log in to Synapse on first use and reuse the client, and its pooled HTTP
+    session, across warm invocations.
+    """
+    syn, syn_pat = _clients.get('synapse', (None, None))
+    if syn is None or syn_pat != pat:
+        synapseclient = _import('synapseclient')
+        synapseclient.core.cache.CACHE_ROOT_DIR = '/tmp/.synapseCache'
+        session = _import('requests').Session()
+        adapter = _import('requests.adapters').HTTPAdapter(pool_maxsize=SYNAPSE_WORKERS)
+        session.mount('https://', adapter)
+        session.hooks['response'].append(_on_synapse_response)
+        syn = synapseclient.Synapse(requests_session=session)
+        _synapse_call(syn.login, authToken=pat)
+        _clients['synapse'] = (syn, pat)
+    return syn
+
+def _submit(stage, method, *args, **kwargs):
+    """
+    Run a Synapse call on the shared thread pool, timed under stage.
+    """
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=SYNAPSE_WORKERS)
+
+    def call():
+        with _metrics.timer(stage):
+            return _synapse_call(method, *args, **kwargs)
+    return _executor.submit(call)
+
+def _synapse_call(method, *args, **kwargs):
+    """
+    Call a Synapse client method under the rate limiter. synapseclient
+    retries throttled requests.
+    """
+    _rate_limiter.acquire()
+    return method(*args, **kwargs)
+
+def _on_synapse_response(response, *args, **kwargs):
+    """
+    Session response hook counting every Synapse HTTP request, including
+    synapseclient's internal retries, and adapting the rate limiter to it.
+    """
+    _metrics.count('SynapseRequests')
+    if response.status_code in THROTTLE_STATUS_CODES:
+        _rate_limiter.throttled()
+        _metrics.count('SynapseThrottled')
+    else:
+        _rate_limiter.succeeded()
+
+def _import(name):
+    """
+    Import a module on first use and log how long the import took.
+    """
+    if name not in _modules:
+        start = time.perf_counter()
+        _modules[name] = importlib.import_module(name)
+        print("Imported {} in {:.1f} ms.".format(name, (time.perf_counter() - start) * 1000))
+    return _modules[name]
+
+def _get_client(name):
+    """
+    Create a boto3 client on first use and reuse it across invocations.
+    """
+    if name not in _clients:
+        start = time.perf_counter()
+        _clients[name] = _import('boto3').client(name)
+        print("Created {} client in {:.1f} ms.".format(name, (time.perf_counter() - start) * 1000))
+    return _clients[name]
+
+def _get_resource(name):
+    """
+    Create a boto3 resource on first use and reuse it across invocations.
+    """
+    key = name + ':resource'
+    if key not in _clients:
+        start = time.perf_counter()
+        _clients[key] = _import('boto3').resource(name)
+        print("Created {} resource in {:.1f} ms.".format(name, (time.perf_counter() - start) * 1000))
+    return _clients[key]
+
 def _get_env_var(name):
     value = os.getenv(name)
     if not value:
         raise ValueError(('Lambda configuration error: '
             f'missing environment variable {name}'))
     return value
+
+_IMPORT_DONE = time.perf_counter()
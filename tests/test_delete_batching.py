@@ -0,0 +1,143 @@
+import json
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir, 's3_synapse_sync'))
+import lambda_function  # noqa: E402
+
+
+class FakeSynapse:
+    """
+    Entities keyed by (parent ID, name), recording every call made.
+    """
+
+    def __init__(self, entities):
+        self.entities = dict(entities)
+        self.calls = []
+
+    def findEntityId(self, name, parent):
+        self.calls.append(('findEntityId', name, parent))
+        return self.entities.get((parent, name))
+
+    def delete(self, entity_id):
+        self.calls.append(('delete', entity_id))
+        deleted = {entity_id}
+        while True:
+            children = {v for (parent, name), v in self.entities.items() if parent in deleted}
+            if children <= deleted:
+                break
+            deleted |= children
+        self.entities = {k: v for k, v in self.entities.items() if v not in deleted}
+
+
+class FakeS3:
+    def __init__(self, keys):
+        self.keys = set(keys)
+
+    def list_objects_v2(self, Bucket, Prefix, MaxKeys):
+        return {'KeyCount': min(MaxKeys, sum(key.startswith(Prefix) for key in self.keys))}
+
+
+@pytest.fixture(autouse=True)
+def reset_state(monkeypatch):
+    monkeypatch.setattr(lambda_function, '_metrics', lambda_function.Metrics())
+    monkeypatch.setattr(lambda_function, '_deleted_paths', lambda_function.OrderedDict())
+    monkeypatch.setattr(lambda_function, '_clients', {})
+
+
+def record(key, event_name='ObjectRemoved:Delete', sequencer='00'):
+    return {'eventName': event_name,
+            's3': {'bucket': {'name': 'bucket'},
+                   'object': {'key': key, 'sequencer': sequencer}}}
+
+
+def test_collapse_prefixes_drops_keys_under_removed_folder():
+    keys = ['a/b/x.txt', 'a/b/', 'a/b/c/y.txt', 'a/bc/d', 'a/z.txt']
+    assert lambda_function.collapse_prefixes(keys) == ['a/b/', 'a/bc/d', 'a/z.txt']
+
+
+def test_collapse_prefixes_keeps_sibling_prefixes():
+    keys = ['a/b/', 'a/bc/d', 'a/bc/']
+    assert lambda_function.collapse_prefixes(keys) == ['a/b/', 'a/bc/']
+
+
+def test_common_prefixes_shallowest_first():
+    keys = ['a/b/c/x.txt', 'a/bc/d', 'e/f/']
+    assert lambda_function.common_prefixes(keys) == ['a/', 'e/', 'a/b/', 'a/bc/', 'a/b/c/']
+
+
+def test_unwrap_sqs_records_keeps_latest_event_per_key():
+    def message(*records):
+        return {'eventSource': 'aws:sqs', 'body': json.dumps({'Records': list(records)})}
+
+    event = {'Records': [
+        message(record('a/x.txt', 'ObjectCreated:Put', '0B')),
+        message(record('a/x.txt', 'ObjectRemoved:Delete', '0A')),
+        message(record('a/y.txt')),
+        {'eventSource': 'aws:sqs', 'body': json.dumps({'Event': 's3:TestEvent'})},
+    ]}
+    records = lambda_function.unwrap_records(event)
+    assert [(r['s3']['object']['key'], r['eventName']) for r in records] == [
+        ('a/x.txt', 'ObjectCreated:Put'), ('a/y.txt', 'ObjectRemoved:Delete')]
+
+
+def test_delete_empty_prefix_in_one_call(monkeypatch):
+    syn = FakeSynapse({('p', 'a'): 'A', ('A', 'b'): 'B', ('B', 'x.txt'): 'X',
+                       ('B', 'y.txt'): 'Y', ('A', 'keep.txt'): 'K'})
+    lambda_function._clients['s3'] = FakeS3(['a/keep.txt'])
+    monkeypatch.setattr(lambda_function, 'login_synapse', lambda bucket: (syn, 'p'))
+
+    lambda_function.delete_from_synapse('bucket', ['a/b/x.txt', 'a/b/y.txt', '1a/z.txt'])
+
+    assert [call for call in syn.calls if call[0] == 'delete'] == [('delete', 'B')]
+    assert ('A', 'keep.txt') in syn.entities
+    assert lambda_function._metrics.counts['DeletesCollapsed'] == 1
+
+
+def test_recently_deleted_folder_skips_children():
+    syn = FakeSynapse({('p', 'a'): 'A', ('A', 'b'): 'B', ('B', 'x.txt'): 'X'})
+    lambda_function.delete_object(syn, '', 'p', 'a/b/')
+    syn.calls.clear()
+
+    assert lambda_function._was_deleted(syn, 'p', 'a/b/x.txt')
+    assert syn.calls == [('findEntityId', 'b', 'A')]
+
+
+def test_deleted_path_expires_after_ttl(monkeypatch):
+    syn = FakeSynapse({('p', 'a'): 'A', ('A', 'b'): 'B'})
+    lambda_function.delete_object(syn, '', 'p', 'a/b/')
+    monkeypatch.setattr(lambda_function, 'DELETED_PATH_TTL', 0)
+    syn.calls.clear()
+
+    assert not lambda_function._was_deleted(syn, 'p', 'a/b/x.txt')
+    assert syn.calls == []
+    assert not lambda_function._deleted_paths
+
+
+def test_recreated_path_is_evicted_and_deleted():
+    syn = FakeSynapse({('p', 'a'): 'A', ('A', 'b'): 'B', ('B', 'x.txt'): 'X'})
+    lambda_function.delete_object(syn, '', 'p', 'a/b/')
+
+    # Another container re-creates the folder and file
+    syn.entities.update({('A', 'b'): 'B2', ('B2', 'x.txt'): 'X2'})
+    assert not lambda_function._was_deleted(syn, 'p', 'a/b/x.txt')
+    assert ('p', 'a/b') not in lambda_function._deleted_paths
+
+    lambda_function.delete_object(syn, 'x.txt', 'p', 'a/b/x.txt')
+    assert ('B2', 'x.txt') not in syn.entities
+
+
+def test_create_event_forgets_deleted_ancestors(monkeypatch):
+    syn = FakeSynapse({('p', 'a'): 'A', ('A', 'b'): 'B'})
+    lambda_function.delete_object(syn, '', 'p', 'a/b/')
+    created = []
+    monkeypatch.setattr(lambda_function, 'login_synapse', lambda bucket: (syn, 'p'))
+    monkeypatch.setattr(lambda_function, 'create_filehandle',
+                        lambda syn, event, filename, bucket, key, project_id: created.append(key))
+
+    lambda_function.sync_to_synapse('bucket', {}, 'ObjectCreated:Put', 'x.txt', 'a/b/x.txt')
+
+    assert created == ['a/b/x.txt']
+    assert not lambda_function._deleted_paths
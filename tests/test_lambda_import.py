@@ -0,0 +1,34 @@
+import json
+import os
+import subprocess
+import sys
+
+LAMBDA_DIR = os.path.join(os.path.dirname(__file__), os.pardir, 's3_synapse_sync')
+# Budget for importing lambda_function, excluding interpreter start up
+COLD_START_BUDGET_MS = 250
+
+IMPORT_SCRIPT = '''
+import json
+import sys
+sys.path.insert(0, sys.argv[1])
+import lambda_function
+print(json.dumps({
+    'import_ms': (lambda_function._IMPORT_DONE - lambda_function._IMPORT_START) * 1000,
+    'modules': [name for name in ('boto3', 'botocore', 'synapseclient') if name in sys.modules],
+}))
+'''
+
+
+def cold_import():
+    # A fresh interpreter so nothing is already imported or cached
+    output = subprocess.run([sys.executable, '-c', IMPORT_SCRIPT, LAMBDA_DIR],
+                            check=True, capture_output=True, text=True).stdout
+    return json.loads(output.splitlines()[-1])
+
+
+def test_heavy_modules_not_imported():
+    assert cold_import()['modules'] == []
+
+
+def test_cold_start_budget():
+    assert cold_import()['import_ms'] < COLD_START_BUDGET_MS